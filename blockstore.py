@@ -49,13 +49,26 @@ class BlockStore(rpyc.Service):
         else:
             return False
 
+    """
+        [True/False, ...] = has_blocks_batch(hs) : Signals, for every hash in hs, whether the block
+        indexed by it exists in the BlockStore service. Lets the MetadataStore check a whole hashlist
+        in a single round-trip instead of one has_block() call per hash.
+        As per rpyc syntax, adding the prefix 'exposed_' will expose this method as an RPC call
+    """
+
+    def exposed_has_blocks_batch(self, hs):
+        print("has_blocks_batch()")
+        return tuple(h in self.hash_table for h in hs)
+
     def exposed_ping(self):
         print("ping()")
         return 1
 
 if __name__ == '__main__':
     from rpyc.utils.server import ThreadedServer
+    from rpycutil import disable_docstring_transfer
 
+    disable_docstring_transfer()
     port = int(sys.argv[1])
     server = ThreadedServer(BlockStore(), port=port)
     server.start()
\ No newline at end of file
@@ -4,7 +4,7 @@ import os
 import sys
 import time
 import copy
-from metastore import parse_config, connection_to
+from metastore import parse_config, connection_to, ERR_MISSING_BLOCKS, ERR_WRONG_VERSION, ERR_BLOCKSTORE_UNAVAILABLE
 
 """
 A client is a program that interacts with SurfStore. It is used to create,
@@ -78,13 +78,15 @@ class SurfStoreClient():
         except Exception as e:
             # extract version and missing blocks from msg
             new_server_version = int(server_version)
-            if e.error_type == 1:
+            if e.error_type == ERR_MISSING_BLOCKS:
                 # missing blocks
-                missing_blocks = list(eval(e.missing_blocks))
-                # missing_blocks = list(e.missing_blocks)
-            elif e.error_type == 2:
+                missing_blocks = list(e.payload)
+            elif e.error_type == ERR_WRONG_VERSION:
                 # version error
-                new_server_version = int(e.current_version)
+                new_server_version = int(e.payload)
+            elif e.error_type == ERR_BLOCKSTORE_UNAVAILABLE:
+                print("BlockStore Server #" + str(e.payload) + " unavailable.")
+                return
         
         # send missing blocks to blockstore
         for key in missing_blocks:
@@ -1,6 +1,13 @@
 import rpyc
+import collections
+import itertools
+import os
+import re
 import sys
-import copy
+import threading
+from rpyc.core.protocol import PingError
+from rpyc.utils.classic import obtain
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 '''
 A sample ErrorResponse class. Use this to respond to client requests when the request has any of the following issues - 
@@ -17,21 +24,131 @@ maintain the data.
 '''
 
 
+# ErrorResponse.error_type values
+ERR_MISSING_BLOCKS = 1  # payload: tuple of the missing hashes
+ERR_WRONG_VERSION = 2  # payload: current version of the file
+ERR_NOT_FOUND = 3  # payload: None
+ERR_BLOCKSTORE_UNAVAILABLE = 4  # payload: number of the blockstore that cannot be reached
+ERR_INVALID_FILENAME = 5  # payload: None
+
+
 class ErrorResponse(Exception):
-    def __init__(self, message):
+    __slots__ = ('error', 'error_type', 'payload')
+
+    def __init__(self, message, error_type, payload=None):
         super(ErrorResponse, self).__init__(message)
         self.error = message
+        self.error_type = error_type
+        self.payload = payload
+
+
+# ((hashkey, blocklocation),(),(),(),..)
+HashList = Tuple[Tuple[str, int], ...]
+
+
+class FileEntry(object):
+    """
+        Everything the MetadataStore knows about one file: its latest version,
+        its hashlist and whether it has been deleted. Deleted files keep their
+        entry (a tombstone) so that the version keeps counting up.
+
+        An entry is never modified once it is stored: writers build a new entry
+        and swap it in under the shard lock, so a reader always sees a version
+        together with its own hashlist without taking any lock.
+    """
+    __slots__ = ('version', 'hashlist', 'deleted')
 
-    def missing_blocks(self, hashlist):
-        self.error_type = 1
-        self.missing_blocks = hashlist
+    def __init__(self, version: int, hashlist: Optional[HashList], deleted: bool = False) -> None:
+        self.version = version
+        self.hashlist = hashlist  # None when deleted
+        self.deleted = deleted
 
-    def wrong_version_error(self, version):
-        self.error_type = 2
-        self.current_version = version
 
-    def file_not_found(self):
-        self.error_type = 3
+# number of connections opened to every blockstore; 1 keeps a single shared connection per blockstore
+BLOCKSTORE_POOL_SIZE = 4
+
+# errors raised by rpyc when the peer has dropped the connection
+BROKEN_CONNECTION_ERRORS = (EOFError, PingError)
+
+# config for the connections opened to blockstores; leaves out data the blockstores never use
+BLOCKSTORE_CONN_CONFIG = {'include_local_version': False, 'include_local_traceback': False}
+
+# number of worker threads serving client connections to the MetadataStore
+METADATA_SERVER_THREADS = 32
+
+# number of lock-striped shards the file table is split into; must be a power of two
+NO_OF_SHARDS = 16
+
+
+class BlockStoreConn(object):
+    """
+        A pooled connection to a blockstore. Looking up a method on conn.root is
+        a round-trip of its own, so the async wrapper of has_blocks_batch() is
+        looked up once when the connection is opened and kept next to it. For a
+        blockstore without has_blocks_batch() this also remembers that it is
+        missing, and keeps the wrapper of has_block() instead.
+
+        Unlike sync calls, async results never time out on their own, so every
+        result gets the connection's sync_request_timeout as expiry; a hung
+        blockstore then raises rpyc.AsyncResultTimeout instead of blocking the
+        MetadataStore worker forever.
+    """
+    __slots__ = ('conn', 'timeout', 'has_blocks_batch', 'has_block')
+
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.timeout: Any = conn._config['sync_request_timeout']
+        self.has_blocks_batch: Any = None
+        self.has_block: Any = None
+        try:
+            self.has_blocks_batch = rpyc.async_(conn.root.has_blocks_batch)
+        except AttributeError:
+            self.has_block = rpyc.async_(conn.root.has_block)
+
+    @property
+    def closed(self) -> bool:
+        return self.conn.closed
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def abort(self) -> None:
+        # close() says goodbye to the blockstore with a sync request, which a hung
+        # blockstore would make us wait for again; close the socket underneath first
+        self.conn._channel.close()
+        self.conn.close()
+
+    '''
+        Asks the blockstore which of hashes it has, without waiting for the
+        reply. Returns a function that waits for the reply and returns it as a
+        tuple of booleans, one per hash.
+    '''
+
+    def has_blocks_async(self, hashes: Tuple[str, ...]) -> Callable[[], Tuple[bool, ...]]:
+        if self.has_blocks_batch is None:
+            # blockstore without has_blocks_batch(): pipeline one has_block() per hash instead,
+            # all requests are sent before the first reply is awaited
+            results = [self.has_block(hashkey) for hashkey in hashes]
+            for result in results:
+                result.set_expiry(self.timeout)
+            return lambda: tuple(result.value for result in results)
+
+        result = self.has_blocks_batch(hashes)
+        result.set_expiry(self.timeout)
+        return lambda: result.value
+
+
+def intern_filename(filename: object) -> str:
+    # filenames are str; interned ones are shared by every entry and lookup for the same file
+    if not isinstance(filename, str):
+        raise ErrorResponse("Invalid Filename", ERR_INVALID_FILENAME)
+    return sys.intern(filename)
+
+
+def check_version(entry: FileEntry, version: int) -> None:
+    # the version provided must be exactly one larger than the current version
+    if version != entry.version + 1:
+        raise ErrorResponse("Version Error", ERR_WRONG_VERSION, entry.version)
 
 
 class MetadataStore(rpyc.Service):
@@ -40,14 +157,13 @@ class MetadataStore(rpyc.Service):
         any datastructures you may need.
     """
 
-    def __init__(self, config):
-        self.filename_hashlist = dict()  # str -> [[hashkey, blocklocation],[],[],[],..]
-        self.filename_version = dict()  # str -> int
-
-        self.tombstone_filename_version = dict()  # str -> int
+    def __init__(self, config, pool_size=BLOCKSTORE_POOL_SIZE):
+        # str -> FileEntry, striped over shards by hash(filename) so that concurrent
+        # requests for different files only contend when they land in the same shard
+        self.shards = [{"files": dict(), "lock": threading.Lock()} for _ in range(NO_OF_SHARDS)]
         '''
-            When file is deleted, it is removed from filename_hashlist and filename_version;
-            It is added into tombstone_filename_version with associated with its latest version
+            When file is deleted, its entry is kept as a tombstone: hashlist is dropped,
+            deleted is set and the entry keeps its latest version
         '''
 
         configuration = parse_config(config)
@@ -55,8 +171,74 @@ class MetadataStore(rpyc.Service):
         self.metadata = configuration[1]
         self.blockstores = configuration[2]
 
-        # build connection pool of connections with all blockstores
-        self.blockstore_conns = connection_to(self.blockstores)  # list of connections with every blockstore
+        # build connection pool of connections with all blockstores; a slow reply on one
+        # connection then only holds up the requests that were handed that connection.
+        # Connections are opened lazily, so a blockstore that is down does not prevent startup
+        self.blockstore_pools = [[None] * pool_size for _ in self.blockstores]
+        self.blockstore_cycles = [itertools.cycle(range(pool_size)) for _ in self.blockstores]
+        self.blockstore_pool_locks = [threading.Lock() for _ in self.blockstores]
+        self.blockstore_slot_locks = [[threading.Lock() for _ in range(pool_size)] for _ in self.blockstores]
+
+    '''
+        Hands out the connections to blockstore server_no in round-robin order,
+        (re)connecting the pool slot if it was never opened or has been closed.
+        Returns the pool slot together with its connection.
+    '''
+
+    def _get_conn(self, server_no):
+        with self.blockstore_pool_locks[server_no]:
+            slot = next(self.blockstore_cycles[server_no])
+            conn = self.blockstore_pools[server_no][slot]
+        if conn is None or conn.closed:
+            conn = self._reconnect(server_no, slot, conn)
+        return slot, conn
+
+    '''
+        Replaces the connection stale in pool slot slot of blockstore server_no
+        by a new one. Only the lock of that slot is held while connecting, so an
+        unreachable blockstore does not hold up requests to the others, and
+        requests finding the same slot stale wait for one new connection instead
+        of each opening their own.
+    '''
+
+    def _reconnect(self, server_no, slot, stale):
+        with self.blockstore_slot_locks[server_no][slot]:
+            current = self.blockstore_pools[server_no][slot]
+            if current is not stale:
+                # another request has reconnected this slot in the meantime, use its connection
+                return current
+
+            if stale is not None:
+                try:
+                    stale.close()
+                except (EOFError, OSError):
+                    pass
+            try:
+                conn = BlockStoreConn(connect(self.blockstores[server_no]))
+            except (OSError,) + BROKEN_CONNECTION_ERRORS:
+                raise ErrorResponse("Blockstore Unavailable", ERR_BLOCKSTORE_UNAVAILABLE, server_no)
+
+            with self.blockstore_pool_locks[server_no]:
+                self.blockstore_pools[server_no][slot] = conn
+            return conn
+
+    '''
+        Asks blockstore server_no again which of hashes it has, after conn broke
+        down, e.g. because the blockstore was restarted. The pool slot of conn is
+        reconnected first; if that does not help either, the blockstore is
+        reported as unavailable.
+    '''
+
+    def _retry_has_blocks(self, server_no, slot, conn, hashes):
+        conn = self._reconnect(server_no, slot, conn)
+        try:
+            return conn.has_blocks_async(hashes)()
+        except BROKEN_CONNECTION_ERRORS + (rpyc.AsyncResultTimeout,):
+            conn.abort()
+            raise ErrorResponse("Blockstore Unavailable", ERR_BLOCKSTORE_UNAVAILABLE, server_no)
+
+    def _shard(self, filename: str) -> dict:
+        return self.shards[hash(filename) & (NO_OF_SHARDS - 1)]
 
     '''
         ModifyFile(f,v,hl): Modifies file f so that it now contains the
@@ -68,48 +250,87 @@ class MetadataStore(rpyc.Service):
         method as an RPC call
     '''
 
-    def exposed_modify_file(self, filename, version, hashlist):
+    def exposed_modify_file(self, filename: object, version: Union[int, str], hashlist) -> int:
+        filename = intern_filename(filename)
+        version = int(version)
+
         # make a local copy!
         # hashlist = list(hashlist)
 
-        # Very IMPORTANT! For more complex data structure, list() is not enough for copying
-        # Use deepcopy and don't forget to set 'allow_pickle: True' in configuration
-        hashlist = copy.deepcopy(hashlist)
+        # Very IMPORTANT! hashlist is a netref, so list() or deepcopy() would fetch every
+        # element with its own round-trip. obtain() pickles the whole structure on the
+        # client and transfers it at once; don't forget to set 'allow_pickle: True' in configuration
+        hashlist = obtain(hashlist)
 
-        # check version
-        if filename in self.filename_version and int(version) != self.filename_version[filename] + 1:
-            error = ErrorResponse("Version Error")
-            error.wrong_version_error(self.filename_version[filename])
-            raise error
+        # freeze it into a tuple of tuples: nobody can mutate the stored version afterwards,
+        # so read_file() can hand out the same object to every reader without copying it
+        hashlist = tuple((str(hashkey), int(server_no)) for hashkey, server_no in hashlist)
 
-        # gather missing blocks
-        missing_block_list = list()
+        shard = self._shard(filename)
+        files = shard["files"]
+
+        # check version
+        with shard["lock"]:
+            entry = files.get(filename)
+            if entry is not None and not entry.deleted:
+                check_version(entry, version)
 
-        for hashnode in hashlist:
-            server_no = hashnode[1]
-            conn = self.blockstore_conns[server_no]
-            if not conn.root.has_block(hashnode[0]):
-                missing_block_list.append(hashnode[0])
+        # gather missing blocks, without holding the shard lock during the blockstore round-trips
+        missing_block_list = self.missing_blocks(group_by_server(hashlist))
 
         if len(missing_block_list) == 0:
-            # modify filename -> version
-            if filename in self.filename_hashlist:
-                self.filename_version[filename] += 1
-            elif filename in self.tombstone_filename_version:
-                self.filename_version[filename] = self.tombstone_filename_version[filename] + 1
-                del self.tombstone_filename_version[filename]
-            else:
-                self.filename_version[filename] = 1
-
-            # modify filename -> hashlist
-            self.filename_hashlist[filename] = hashlist
-            # print(self.filename_hashlist)
+            with shard["lock"]:
+                # check version again, another writer may have modified the file in the meantime
+                entry = files.get(filename)
+                if entry is not None and not entry.deleted:
+                    check_version(entry, version)
+
+                # modify filename -> version, hashlist
+                if entry is None:
+                    files[filename] = FileEntry(1, hashlist)
+                else:
+                    files[filename] = FileEntry(entry.version + 1, hashlist)
             return 0
         else:
-            error = ErrorResponse("Missing Block")
-            error.missing_blocks(missing_block_list)
-            # error.missing_blocks(tuple(missing_block_list))
-            raise error
+            # a tuple is sent by value, so the client gets the hashes without another round-trip
+            raise ErrorResponse("Missing Block", ERR_MISSING_BLOCKS, tuple(missing_block_list))
+
+    '''
+        Returns the hashes in server_hashes (see group_by_server()) whose blocks
+        are not present in their blockstore. Every blockstore is asked only once
+        through has_blocks_batch(), and the queries to all blockstores are fired
+        asynchronously so that their round-trips overlap.
+    '''
+
+    def missing_blocks(self, server_hashes: Dict[int, Tuple[str, ...]]) -> List[str]:
+        pending = list()
+        for server_no, hashes in server_hashes.items():
+            slot, conn = self._get_conn(server_no)
+            try:
+                result = conn.has_blocks_async(hashes)
+            except BROKEN_CONNECTION_ERRORS:
+                result = None
+            pending.append((server_no, hashes, slot, conn, result))
+
+        missing_block_list = list()
+        for server_no, hashes, slot, conn, result in pending:
+            present_list = None
+            if result is not None:
+                try:
+                    present_list = result()
+                except rpyc.AsyncResultTimeout:
+                    # the blockstore is hung rather than restarted, retrying would only wait again
+                    conn.abort()
+                    raise ErrorResponse("Blockstore Unavailable", ERR_BLOCKSTORE_UNAVAILABLE, server_no)
+                except BROKEN_CONNECTION_ERRORS:
+                    pass
+            if present_list is None:
+                # the blockstore dropped the connection, e.g. it was restarted: reconnect and retry once
+                present_list = self._retry_has_blocks(server_no, slot, conn, hashes)
+            for hashkey, present in zip(hashes, present_list):
+                if not present:
+                    missing_block_list.append(hashkey)
+        return missing_block_list
 
     '''
         DeleteFile(f,v): Deletes file f. Like ModifyFile(), the provided
@@ -119,29 +340,23 @@ class MetadataStore(rpyc.Service):
         method as an RPC call
     '''
 
-    def exposed_delete_file(self, filename, version):
-        # check version
-        if filename in self.filename_version:
-            # print("1," + str(version) + " " + str(self.filename_version[filename]))
-            if int(version) != self.filename_version[filename] + 1:
-                error = ErrorResponse("Version Error")
-                error.wrong_version_error(self.filename_version[filename])
-                raise error
-            self.tombstone_filename_version[filename] = self.filename_version[filename] + 1
-            del self.filename_hashlist[filename]
-            del self.filename_version[filename]
-            return self.tombstone_filename_version[filename]
-        elif filename in self.tombstone_filename_version:
-            # print("2," + str(version) + " " + str(self.tombstone_filename_version[filename]))
-            if int(version) != self.tombstone_filename_version[filename] + 1:
-                error = ErrorResponse("Version Error")
-                error.wrong_version_error(self.tombstone_filename_version[filename])
-                raise error
-            self.tombstone_filename_version[filename] += 1
-            return self.tombstone_filename_version[filename]
-        else:
-            error = ErrorResponse("Not Found")
-            raise error
+    def exposed_delete_file(self, filename: object, version: Union[int, str]) -> int:
+        filename = intern_filename(filename)
+        version = int(version)
+
+        shard = self._shard(filename)
+        files = shard["files"]
+        with shard["lock"]:
+            entry = files.get(filename)
+            if entry is None:
+                raise ErrorResponse("Not Found", ERR_NOT_FOUND)
+
+            # check version
+            check_version(entry, version)
+
+            # deleting a live file turns it into a tombstone; deleting a tombstone only bumps its version
+            files[filename] = FileEntry(entry.version + 1, None, deleted=True)
+            return entry.version + 1
 
     '''
         (v,hl) = ReadFile(f): Reads the file with filename f, returning the
@@ -152,22 +367,57 @@ class MetadataStore(rpyc.Service):
         method as an RPC call
     '''
 
-    def exposed_read_file(self, filename):
-        if filename in self.filename_hashlist:
-            version = self.filename_version[filename]
-            hashlocation = self.filename_hashlist[filename]
-            return version, hashlocation
-        elif filename in self.tombstone_filename_version:
-            version = self.tombstone_filename_version[filename]
-            return version, list()
+    def exposed_read_file(self, filename: object) -> Tuple[int, HashList]:
+        filename = intern_filename(filename)
+
+        # no lock needed: entries are immutable and the dict lookup is atomic
+        entry = self._shard(filename)["files"].get(filename)
+        # only tuples of str/int are returned: rpyc sends those by value in a single
+        # message, while a list would reach the client as a netref fetched element by element
+        if entry is None:
+            return 0, ()
+        elif entry.deleted:
+            return entry.version, ()
         else:
-            return 0, list()
+            return entry.version, entry.hashlist
+
+
+# path -> ((st_mtime_ns, st_size), parsed configuration)
+_CONFIG_CACHE: Dict[str, Tuple[Tuple[int, int], tuple]] = dict()
 
 
 def parse_config(config):
-    # read config file
-    with open(config, "r") as text:
-        lines = text.readlines()
+    # skip re-parsing when the config file has not changed since the last call
+    st = os.stat(config)
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _CONFIG_CACHE.get(config)
+    if cached is not None and cached[0] == key:
+        parsed = cached[1]
+    else:
+        parsed = _parse_config(config)
+        _CONFIG_CACHE[config] = (key, parsed)
+
+    # hand out copies, so that a caller modifying its configuration does not change the cached one
+    no_of_block_stores, metadata, blockstores, block_replacement_algorithm = parsed
+    return no_of_block_stores, dict(metadata), [dict(blockstore) for blockstore in blockstores], \
+        block_replacement_algorithm
+
+
+# matches a "name: host:port" config line
+_ADDRESS_RE = re.compile(r'^[^:]+:\s*(?P<host>[^:\s]+):(?P<port>\d+)\s*$')
+
+
+def _parse_address(line):
+    m = _ADDRESS_RE.match(line)
+    if m is None:
+        raise ValueError("Malformed config line: " + line.strip())
+    return {"host": m.group("host"), "port": m.group("port")}
+
+
+def _parse_config(config):
+    # read config file in one go; splitlines() also drops the trailing newlines
+    with open(config, "rb") as text:
+        lines = text.read().decode().splitlines()
 
     '''
         format:
@@ -178,52 +428,49 @@ def parse_config(config):
 
     # parse config file and extract parameters
     no_of_block_stores = int(lines[0].split(": ")[-1])
-    metadata = dict()
-    metadata["host"] = lines[1].split(": ")[1].split(":")[0]  # type: str
-    metadata["port"] = lines[1].split(": ")[1].split(":")[1]  # type: str
-    if metadata["host"][-1] == '\n':
-        metadata["host"] = metadata["host"][:-1]
-    if metadata["port"][-1] == '\n':
-        metadata["port"] = metadata["port"][:-1]
-
-    blockstores = list()  # a list of dicts
-    # e.g., blockstores = [{'host': 'localhost', 'port': '6000'}, {'host': 'localhost', 'port': '6000'}]
+    metadata = _parse_address(lines[1])
 
+    # a list of dicts
+    # e.g., blockstores = [{'host': 'localhost', 'port': '6000'}, {'host': 'localhost', 'port': '6000'}]
     # extract host:port information of every blockstore server
-    for i in range(no_of_block_stores):
-        line = lines[2 + i]
-        t = dict()
-        t["host"] = line.split(": ")[1].split(":")[0]
-        if t["host"][-1] == '\n':
-            t["host"] = t["host"][:-1]
-        t["port"] = line.split(": ")[1].split(":")[1]
-        if t["port"][-1] == '\n':
-            t["port"] = t["port"][:-1]
-        blockstores.append(t)
+    blockstores = [_parse_address(line) for line in lines[2:2 + no_of_block_stores]]
 
     block_replacement_algorithm = int(lines[2 + no_of_block_stores].split(": ")[-1])
     return no_of_block_stores, metadata, blockstores, block_replacement_algorithm
 
 
+def group_by_server(hashlist: HashList) -> Dict[int, Tuple[str, ...]]:
+    # ((hashkey, server_no), ...) -> {server_no: (hashkey, ...)}
+    server_hashes = collections.defaultdict(list)
+    for hashkey, server_no in hashlist:
+        server_hashes[server_no].append(hashkey)
+    return {server_no: tuple(hashes) for server_no, hashes in server_hashes.items()}
+
+
+def connect(server):
+    host = server["host"]
+    port = int(server["port"])
+    return rpyc.connect(host, port, config=BLOCKSTORE_CONN_CONFIG)
+
+
 def connection_to(servers):
     connections = list()
     for server in servers:
-        host = server["host"]
-        port = int(server["port"])
-        conn = rpyc.connect(host, port)
+        conn = connect(server)
         connections.append(conn)
     return connections
 
 
 if __name__ == '__main__':
 
-    with open(sys.argv[1], "r") as f:
-        lines = f.readlines()
-    host = lines[1].split(": ")[1].split(":")[0]
-    port = lines[1].split(": ")[1].split(":")[1]
-    port = port[:-1]
+    port = parse_config(sys.argv[1])[1]["port"]
+
+    # a bounded pool of worker threads instead of a new thread per connection; only the
+    # exposed_ methods are reachable, so there is no need for allow_all_attrs
+    from rpyc.utils.server import ThreadPoolServer
+    from rpycutil import disable_docstring_transfer
 
-    from rpyc.utils.server import ThreadedServer
-    server = ThreadedServer(MetadataStore(sys.argv[1]), port=int(port), 
-        protocol_config={'allow_all_attrs': True, 'allow_pickle': True})
+    disable_docstring_transfer()
+    server = ThreadPoolServer(MetadataStore(sys.argv[1]), port=int(port), nbThreads=METADATA_SERVER_THREADS,
+        protocol_config={'allow_pickle': True, 'exposed_prefix': 'exposed_'})
     server.start()
@@ -0,0 +1,25 @@
+import rpyc.core.protocol
+import rpyc.lib
+
+'''
+Tweaks to rpyc shared by the BlockStore and MetadataStore servers.
+'''
+
+
+def disable_docstring_transfer():
+    '''
+        rpyc sends the docstring of every method along with the typeinfo of an
+        object the first time the peer builds a netref to it. Nobody reads them,
+        so make the serving side of every connection in this process send empty
+        docstrings instead.
+    '''
+    get_methods = rpyc.lib.get_methods
+    if getattr(get_methods, "strips_docstrings", False):
+        return
+
+    def get_methods_without_docstrings(obj_attrs, obj):
+        return [(name, "") for name, _ in get_methods(obj_attrs, obj)]
+
+    get_methods_without_docstrings.strips_docstrings = True
+    rpyc.lib.get_methods = get_methods_without_docstrings
+    rpyc.core.protocol.get_methods = get_methods_without_docstrings